@@ -1,12 +1,26 @@
 #!/bin/bash python3
-import pymysql
-import json
+import MySQLdb
+import MySQLdb.cursors
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import httpx
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 import os
+import argparse
 import gzip
+import numpy as np
+import tempfile
+import ijson
 from google.oauth2 import service_account
 from google.cloud import storage
 import traceback
+from pathlib import Path
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from diskcache import Cache
 
 """
 This script is used to identify missing and incomplete system data in the Canonn database.
@@ -27,18 +41,35 @@ Around 800 new systems are added each day.
 """
 
 mysql_conn = None
-id64_dict = {}
+reader_conn = None  # streams query results while mysql_conn does the inserts
+bulk_load_bodies = False  # the server allows insert_bodies to LOAD DATA LOCAL INFILE
+recent_id64s = np.empty(0, dtype=np.uint64)  # sorted id64s spansh updated this week
 webhooks = []
 bucket_name = "canonn-downloads"  # should probably use a config file for this
 store = None  # place holder for the storage location.
-
-
-class SSDictCursor(pymysql.cursors.SSCursor, pymysql.cursors.DictCursorMixin):
-    """
-    A cursor that uses server-side cursors and returns rows as dictionaries.
-    """
-
-    pass
+cache = None  # on disk cache of spansh dumps, their validators and counts keyed on id64
+fetch_concurrency = 20  # maximum number of in-flight requests to spansh
+# executemany packs rows into multi-row INSERTs up to this many bytes per statement.
+# It must stay under the server's max_allowed_packet (4MB on older MySQL servers)
+max_stmt_length = 4 * 1000 * 1000
+counted_body_types = frozenset(("Planet", "Star"))  # body types included in lenBodies
+
+retry_statuses = [429, 500, 502, 503, 504]  # transient responses worth retrying
+fetch_retries = 3  # retries for each spansh request, backing off 0.5s, 1s, 2s
+
+# one pooled session for the synchronous requests so connections are reused
+http_session = requests.Session()
+http_session.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=32,
+        pool_maxsize=32,
+        max_retries=Retry(
+            total=fetch_retries, backoff_factor=0.5, status_forcelist=retry_statuses
+        ),
+    ),
+)
+http_session.headers["User-Agent"] = "Canonn firmament.py"
 
 
 def connect_storage(storage_secrets_file):
@@ -73,13 +104,12 @@ def upload_patrol(rows):
 def load_webhooks(discord_secrets_file):
     print("Discord Secrets File:", discord_secrets_file)
     try:
-        with open(discord_secrets_file, "r") as file:
-            webhooks = json.load(file)
-            return webhooks
+        webhooks = orjson.loads(Path(discord_secrets_file).read_bytes())
+        return webhooks
     except FileNotFoundError:
         print("File not found.")
         return []
-    except json.JSONDecodeError:
+    except orjson.JSONDecodeError:
         print("Error decoding JSON.")
         return []
 
@@ -94,83 +124,204 @@ def send_discord(message, verbosity=False):
     for webhook in webhooks:
         # only send verbose messages
         if webhook.get("verbose") or verbosity:
-            r = requests.post(
+            r = http_session.post(
                 webhook.get("webhook"),
-                data=json.dumps(payload),
+                data=orjson.dumps(payload),
                 headers={"Content-Type": "application/json"},
             )
             print(message)
 
 
-def connect_database(database_secrets_file):
-    global mysql_conn  # Declare `mysql_conn` as a global variable
+def connect_database(database_secrets_file, local_infile_dir=None):
     print("Database Secrets File:", database_secrets_file)
 
-    # Open the JSON file containing database secrets
-    with open(database_secrets_file) as json_file:
-        secret = json.load(json_file)  # Load the JSON data into a dictionary
-
-        # Establish a connection to the MySQL database
-        mysql_conn = pymysql.connect(
-            host=secret.get("DB_HOST"),  # Get the host from secrets
-            user=secret.get("DB_USER"),  # Get the username from secrets
-            password=secret.get("DB_PASSWORD"),  # Get the password from secrets
-            db=secret.get("DB_NAME"),  # Get the database name from secrets
-            port=int(
-                secret.get("DB_PORT", 3306)
-            ),  # Get the port from secrets, default to 3306 if not provided
-            charset="utf8",  # Set the character set to UTF-8,
-            # cursorclass=SSDictCursor,
-            cursorclass=pymysql.cursors.DictCursor,
-        )
-        return mysql_conn
+    # Load the JSON file containing database secrets into a dictionary
+    secret = orjson.loads(Path(database_secrets_file).read_bytes())
+
+    # LOAD DATA LOCAL INFILE lets the server ask for any file the client can read,
+    # so it is only enabled when asked for and then only for files in one directory
+    options = {}
+    if local_infile_dir:
+        options["local_infile_dir"] = local_infile_dir
+
+    # Establish a connection to the MySQL database
+    conn = MySQLdb.connect(
+        host=secret.get("DB_HOST"),  # Get the host from secrets
+        user=secret.get("DB_USER"),  # Get the username from secrets
+        password=secret.get("DB_PASSWORD"),  # Get the password from secrets
+        db=secret.get("DB_NAME"),  # Get the database name from secrets
+        port=int(
+            secret.get("DB_PORT", 3306)
+        ),  # Get the port from secrets, default to 3306 if not provided
+        charset="utf8mb4",  # orjson writes 4-byte UTF-8 unescaped
+        cursorclass=MySQLdb.cursors.DictCursor,
+        autocommit=False,  # store_systems commits each batch as one transaction
+        **options,
+    )
+    return conn
 
 
 def count_bodies(bodies):
-    bodyCount = 0
+    return sum(1 for body in bodies if body["type"] in counted_body_types)
+
+
+def serialise_system(data):
+    # one pass over the bodies both counts the planets and stars and serialises them.
+    # Only called for systems we keep, so rejected systems never pay for the dumps
+    bodies = data.pop("bodies")
+    system_address = data["id64"]
+    body_values = []
+    len_bodies = 0
+
     for body in bodies:
-        if body.get("type") in ["Planet", "Star"]:
-            bodyCount += 1
-    return bodyCount
+        if body["type"] in counted_body_types:
+            len_bodies += 1
+        body["systemAddress"] = system_address
+        body_values.append(orjson.dumps(body).decode())
 
+    data["lenBodies"] = len_bodies
+    return orjson.dumps(data).decode(), body_values
 
-def fetch_systems(rows, complete):
-    session = requests.Session()
-    headers = {"User-Agent": "Canonn firmament.py"}
-    systems = []
 
-    for row in rows:
+def retry_after(response):
+    # seconds the server asked us to wait, which may be given as an HTTP date
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return 0
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return 0
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+def spansh_client():
+    # spansh speaks HTTP/2 so the requests are multiplexed over a single connection
+    # large dumps can take a while to stream so allow a generous read timeout, and
+    # let the transport retry failed connection attempts
+    limits = httpx.Limits(
+        max_connections=fetch_concurrency, max_keepalive_connections=fetch_concurrency
+    )
+    transport = httpx.AsyncHTTPTransport(http2=True, limits=limits, retries=3)
+    timeout = httpx.Timeout(30, read=300)
+    return httpx.AsyncClient(
+        headers={"User-Agent": "Canonn firmament.py"},
+        transport=transport,
+        timeout=timeout,
+        follow_redirects=True,  # requests and aiohttp followed redirects by default
+    )
 
-        if complete or id64_dict.get(int(row.get("id64"))):
 
-            url = f"https://spansh.co.uk/api/dump/{row.get('id64')}"
-            response = session.get(url, headers=headers)
+async def fetch_systems(client, rows, complete):
+    semaphore = asyncio.Semaphore(fetch_concurrency)
 
-            # Check if the request was successful
-            if response.status_code == 200:
-                # Parse the JSON response
-                data = response.json().get("system")
+    async def fetch_system(client, row):
+        row_id64 = row["id64"]
+        url = f"https://spansh.co.uk/api/dump/{row_id64}"
+        id64 = int(row_id64)
 
-                # if its not complete then we can check for mismatch
-                data["lenBodies"] = count_bodies(data.get("bodies"))
-                if not complete:
-                    changed = not (
-                        data["lenBodies"] == row.get("len_bodies")
-                        and (data.get("bodyCount") or 0) == row.get("body_count")
-                    )
+        def changed(len_bodies, body_count):
+            return not (
+                len_bodies == row["len_bodies"] and body_count == row["body_count"]
+            )
 
-                if complete or not changed:
-                    print(f"Data fetched for update {data.get('name')}")
-                    systems.append(data)
-                else:
-                    print(f"No change {data.get('name')}")
-            else:
-                print(f"Missing {row.get('name')} ({row.get('id64')})")
-        # else:
-        #    print(f"Skipping {row.get('name')} ({row.get('id64')})")
+        # ask spansh to only send the dump if it has changed since we cached it
+        # the cache is sqlite and file I/O so keep it off the event loop
+        cached = await asyncio.to_thread(cache.get, id64)
+        request_headers = {}
+        if cached and cached["etag"]:
+            request_headers["If-None-Match"] = cached["etag"]
+        if cached and cached["last_modified"]:
+            request_headers["If-Modified-Since"] = cached["last_modified"]
+
+        # retry throttling, server errors and dropped streams with the same
+        # backoff as http_session, which also honours Retry-After on 429 and 503.
+        # One bad dump shouldn't abort the whole batch
+        response = None
+        delay = 0
+        for attempt in range(fetch_retries + 1):
+            if attempt:
+                await asyncio.sleep(delay)
+            delay = 0.5 * 2**attempt
+            try:
+                async with semaphore:
+                    response = await client.get(url, headers=request_headers)
+            except httpx.HTTPError as e:
+                error = e
+                continue
+            if response.status_code not in retry_statuses:
+                break
+            if response.status_code in (429, 503):
+                delay = max(delay, retry_after(response))
+
+        if response is None:
+            print(f"Missing {row['name']} ({row_id64}): {error!r}")
+            return None
+
+        # Check if the request was successful
+        if response.status_code == 304 and cached:
+            # the counts were cached with the dump so we can check for mismatch
+            # before paying to parse and serialise it. A 304 we didn't ask for falls
+            # through to Missing below
+            if not complete and changed(cached["len_bodies"], cached["body_count"]):
+                print(f"No change {row['name']}")
+                return None
+            content = cached["content"]
+        elif response.status_code == 200:
+            content = response.content
+        else:
+            print(f"Missing {row['name']} ({row_id64})")
+            return None
+
+        # Parse the JSON response
+        data = orjson.loads(content)["system"]
+
+        body_count = data.get("bodyCount") or 0
+
+        if complete:
+            # every system is kept so the bodies are counted as they are serialised
+            system = serialise_system(data)
+        else:
+            # count first so rejected systems are never serialised
+            data["lenBodies"] = count_bodies(data["bodies"])
+            system = None
+            if not changed(data["lenBodies"], body_count):
+                system = serialise_system(data)
+
+        validators = ("ETag", "Last-Modified")
+        if response.status_code == 200 and any(
+            validator in response.headers for validator in validators
+        ):
+            entry = {
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+                "len_bodies": data["lenBodies"],
+                "body_count": body_count,
+                "content": content,
+            }
+            await asyncio.to_thread(cache.set, id64, entry)
+
+        if system:
+            print(f"Data fetched for update {data['name']}")
+        else:
+            print(f"No change {data['name']}")
+        return system
+
+    systems = await asyncio.gather(
+        *[
+            fetch_system(client, row)
+            for row in rows
+            if complete or recently_updated(int(row["id64"]))
+        ]
+    )
 
-    session.close()
-    return systems
+    return [data for data in systems if data]
 
 
 missing_systems_query = """
@@ -194,8 +345,9 @@ incomplete_systems_query = """
 
 def insert_systems(systems):
     cursor = mysql_conn.cursor()
+    cursor.max_stmt_length = max_stmt_length
     cursor.executemany(
-        "INSERT IGNORE INTO star_systems (raw_json) VALUES (%s) ON DUPLICATE KEY UPDATE raw_json = VALUES(raw_json)",
+        "INSERT INTO star_systems (raw_json) VALUES (%s) ON DUPLICATE KEY UPDATE raw_json = VALUES(raw_json)",
         (systems),
     )
     print(f"{cursor.rowcount} systems out of {len(systems)} inserted.")
@@ -203,68 +355,132 @@ def insert_systems(systems):
     cursor.close()
 
 
+def check_bulk_load():
+    # MySQL 8 ships with local_infile off, in which case every LOAD DATA would fail
+    cursor = mysql_conn.cursor()
+    cursor.execute("SELECT @@GLOBAL.local_infile AS local_infile")
+    enabled = bool(cursor.fetchone()["local_infile"])
+    cursor.close()
+
+    if not enabled:
+        send_discord(
+            "local_infile is disabled on the server, inserting bodies without LOAD DATA",
+            True,
+        )
+    return enabled
+
+
 def insert_bodies(bodies):
     cursor = mysql_conn.cursor()
-    cursor.executemany(
-        "INSERT IGNORE INTO system_bodies (raw_json) VALUES (%s) ON DUPLICATE KEY UPDATE raw_json = VALUES(raw_json)",
-        (bodies),
+
+    if not bulk_load_bodies:
+        cursor.max_stmt_length = max_stmt_length
+        cursor.executemany(
+            "INSERT INTO system_bodies (raw_json) VALUES (%s) ON DUPLICATE KEY UPDATE raw_json = VALUES(raw_json)",
+            (bodies),
+        )
+        print(f"{cursor.rowcount} bodies out of {len(bodies)} inserted.")
+
+        cursor.close()
+        return
+
+    # bulk load the bodies into a per-connection staging table then merge them
+    cursor.execute(
+        "CREATE TEMPORARY TABLE IF NOT EXISTS system_bodies_stage "
+        "(raw_json LONGTEXT CHARACTER SET utf8mb4)"
+    )
+    cursor.execute("DELETE FROM system_bodies_stage")
+
+    with tempfile.NamedTemporaryFile("w", encoding="utf-8", suffix=".jsonl") as f:
+        # serialised json never contains a raw tab or newline so each body is a
+        # single field on its own line, as long as backslashes are not escapes
+        f.write("\n".join(bodies))
+        f.write("\n")
+        f.flush()
+        cursor.execute(
+            "LOAD DATA LOCAL INFILE %s INTO TABLE system_bodies_stage CHARACTER SET utf8mb4 "
+            "FIELDS TERMINATED BY '\\t' ESCAPED BY '' LINES TERMINATED BY '\\n' (raw_json)",
+            (f.name,),
+        )
+
+    cursor.execute(
+        "INSERT INTO system_bodies (raw_json) "
+        "SELECT stage.raw_json FROM system_bodies_stage stage "
+        "ON DUPLICATE KEY UPDATE system_bodies.raw_json = VALUES(raw_json)"
     )
     print(f"{cursor.rowcount} bodies out of {len(bodies)} inserted.")
 
     cursor.close()
 
 
-def process(query, complete=True):
-    global mysql_conn
+def store_systems(system_data):
+    system_values = []
+    body_values = []
 
+    for system_json, bodies in system_data:
+        system_values.append(system_json)
+        body_values.extend(bodies)
+
+    # the systems and their bodies are committed together once per batch
+    try:
+        if len(system_values) > 0:
+            insert_systems(system_values)
+        if len(body_values) > 0:
+            insert_bodies(body_values)
+        mysql_conn.commit()
+    except Exception:
+        mysql_conn.rollback()
+        raise
+
+    return len(system_values), len(body_values)
+
+
+def process(query, complete=True):
     print("Processing query:", query)
     if complete:
         send_discord("Processing Missing Systems", True)
     else:
         send_discord("Processing Incomplete Systems", True)
 
-    cursor = mysql_conn.cursor(pymysql.cursors.DictCursor)
+    # stream the rows from the server rather than buffering the whole result set.
+    # The stream stays open on reader_conn while we query spansh so the inserts
+    # go through mysql_conn, and the server needs to wait for us between batches.
+    cursor = reader_conn.cursor(MySQLdb.cursors.SSDictCursor)
+    cursor.execute("SET SESSION net_write_timeout = 3600")
     cursor.execute(
         query,
     )
 
-    systemcount = 0
-    bodycount = 0
     print("Query executed.")
-    while True:
-        system_values = []
-        body_values = []
-        rows = cursor.fetchmany(200)
-
-        if not rows:
-            break
-
-        print(f"Fetching {len(rows)} systems...")
-        system_data = fetch_systems(rows, complete)
-        print(f"{len(system_data)} systems for insert.")
-
-        for data in system_data:
-
-            if data:
-                bodies = data.pop("bodies", [])
-
-                for body in bodies:
-                    body["systemAddress"] = data.get("id64")
-                    body_json = json.dumps(body)
-                    body_values.append(body_json)
-
-                system_values.append(json.dumps(data))
-
-        systemcount += len(system_values)
-        bodycount += len(body_values)
-
-        if len(system_values) > 0:
-            insert_systems(system_values)
-        if len(body_values) > 0:
-            insert_bodies(body_values)
-            mysql_conn.commit()
+    stored = []
+    # a single writer thread stores each batch while the next one is fetched from
+    # spansh. mysql_conn is not thread safe so it is only used from that thread.
+    # One event loop and client serve every batch so the spansh connection is kept.
+    with asyncio.Runner() as runner, ThreadPoolExecutor(max_workers=1) as writer:
+        client = spansh_client()
+        try:
+            while True:
+                rows = cursor.fetchmany(200)
+
+                if not rows:
+                    break
+
+                print(f"Fetching {len(rows)} systems...")
+                system_data = runner.run(fetch_systems(client, rows, complete))
+                print(f"{len(system_data)} systems for insert.")
+
+                # wait for the previous batch so only one is ever waiting in memory
+                if stored:
+                    stored[-1].result()
+                stored.append(writer.submit(store_systems, system_data))
+        finally:
+            runner.run(client.aclose())
     # close the cursor we are done
     cursor.close()
+
+    counts = [future.result() for future in stored]
+    systemcount = sum(systems for systems, bodies in counts)
+    bodycount = sum(bodies for systems, bodies in counts)
     kind = "Incomplete"
     update = "Updating"
     if complete:
@@ -279,28 +495,32 @@ def process(query, complete=True):
 
 
 def download_and_process_json():
-    # Download the file
-    response = requests.get("https://downloads.spansh.co.uk/systems_1week.json.gz")
-    response.raise_for_status()  # Ensure the request was successful
+    # Stream the file, decompressing and parsing as it arrives so we never
+    # hold the whole download in memory
+    with http_session.get(
+        "https://downloads.spansh.co.uk/systems_1week.json.gz", stream=True
+    ) as response:
+        response.raise_for_status()  # Ensure the request was successful
 
-    # Decompress the gzip file
-    decompressed_data = gzip.decompress(response.content)
+        gz = gzip.GzipFile(fileobj=response.raw)
 
-    # Load the JSON data
-    data = json.loads(decompressed_data)
+        # we only need to test membership so keep a sorted array of the id64s,
+        # 8 bytes each rather than a python int and a set slot
+        id64s = np.fromiter(ijson.items(gz, "item.id64"), dtype=np.uint64)
+        id64s.sort()
+        return id64s
 
-    # Process the JSON data to create a dictionary keyed on 'id64'
-    result_dict = {}
-    for item in data:
-        id64 = item["id64"]
-        result_dict[id64] = True
 
-    return result_dict
+def recently_updated(id64):
+    # binary search the sorted id64s from download_and_process_json
+    id64 = np.uint64(id64)
+    i = np.searchsorted(recent_id64s, id64)
+    return i < len(recent_id64s) and recent_id64s[i] == id64
 
 
 # function to get statistics about what systems are missing or complte
 def get_system_stats():
-    cursor = mysql_conn.cursor(pymysql.cursors.DictCursor)
+    cursor = mysql_conn.cursor(MySQLdb.cursors.DictCursor)
     cursor.execute(
         """
             select
@@ -348,23 +568,57 @@ def create_patrol():
             (select 1 from system_bodies sb where sb.system_address = ss.id64)            
 ) data
     """
-    cursor = mysql_conn.cursor(pymysql.cursors.DictCursor)
+    cursor = mysql_conn.cursor(MySQLdb.cursors.DictCursor)
     cursor.execute(
         sqltext,
     )
     patrols = cursor.fetchall()
     cursor.close()
 
-    with open("missing_spansh_systems.json", "w") as f:
-        json.dump(patrols, f)
+    Path("missing_spansh_systems.json").write_bytes(orjson.dumps(patrols))
 
     return len(patrols)
 
 
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Load missing and incomplete systems from spansh into the Canonn database."
+    )
+    parser.add_argument(
+        "--missing",
+        action="store_true",
+        help="load systems that are not in the database",
+    )
+    parser.add_argument(
+        "--incomplete",
+        action="store_true",
+        help="reload incomplete systems that spansh updated in the last week",
+    )
+    parser.add_argument(
+        "--patrol",
+        action="store_true",
+        help="create and upload the missing systems patrol",
+    )
+    parser.add_argument(
+        "--all", action="store_true", help="run every phase (the default)"
+    )
+    args = parser.parse_args()
+
+    # with no phases selected we run them all
+    if args.all or not (args.missing or args.incomplete or args.patrol):
+        args.missing = args.incomplete = args.patrol = True
+    return args
+
+
 def main():
-    global id64_dict
+    global mysql_conn
+    global reader_conn
+    global bulk_load_bodies
+    global recent_id64s
     global webhooks
     global store
+    global cache
+    args = parse_args()
     # create the path $HOME/.ssh/database_secrets.json using
     file_location = os.path.join(os.environ["HOME"], ".ssh", "database_secrets.json")
     storage_secrets_file = os.path.join(
@@ -373,30 +627,41 @@ def main():
     webhooks = load_webhooks(
         os.path.join(os.environ["HOME"], ".ssh", "discord_secrets.json")
     )
+    cache = Cache(os.path.join(os.environ["HOME"], ".firmament_cache"))
 
-    mysql_conn = connect_database(file_location)
+    # staging files for insert_bodies are written to the temp directory
+    mysql_conn = connect_database(file_location, local_infile_dir=tempfile.gettempdir())
+    reader_conn = connect_database(file_location)
+    # the reader never writes, and an open transaction would pin its read view so
+    # the incomplete phase could not see what the missing phase inserted
+    reader_conn.autocommit(True)
+    bulk_load_bodies = check_bulk_load()
 
     get_system_stats()
 
     # first we are going to process all the systems that are not in the database
     # then we will work on systems that are out of date
 
-    process(missing_systems_query)
-    id64_dict = download_and_process_json()
+    if args.missing:
+        process(missing_systems_query)
 
-    process(incomplete_systems_query, complete=False)
+    if args.incomplete:
+        recent_id64s = download_and_process_json()
+        process(incomplete_systems_query, complete=False)
 
     # we will create a patrol for incomplete systems and upload
-    store = connect_storage(storage_secrets_file)
-    rows = create_patrol()
-    upload_patrol(rows)
+    if args.patrol:
+        store = connect_storage(storage_secrets_file)
+        rows = create_patrol()
+        upload_patrol(rows)
 
     get_system_stats()
     send_discord("Firmament Complete", True)
 
 
-try:
-    main()
-except Exception as e:
-    send_discord(f"Firmament Error: {e}", True)
-    raise e
+if __name__ == "__main__":
+    try:
+        main()
+    except Exception as e:
+        send_discord(f"Firmament Error: {e}", True)
+        raise e